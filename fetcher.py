@@ -1,29 +1,70 @@
+import concurrent.futures
+import functools
 import itertools
-import json
+import operator
+import orjson
 import os
+import pygit2
+import queue
+import re
 import requests
+import requests.adapters
+import shelve
+import shlex
 import subprocess
+import sys
+import urllib.parse
+import urllib3.util
 
 
 URL_HEADER      =   'https://android-review.googlesource.com'
 CHANGES_HEADER  =   URL_HEADER + '/changes/'
 PROJECT         =   'platform/art'
 BRANCH          =   'master'
-AUTHORS         =   ['Goran Jakovljevic',
+AUTHORS         =   ('Goran Jakovljevic',
                     'Alexey Frunze',
                     'Pavle Batuta', 
                     'Douglas Leung',
                     'Chris Larsen',
                     'Duane Sand',
                     'Nikola Veljkovic',
-                    'Lazar Trsic',]
-
-GERRIT_MAGIC_JSON_PREFIX = ")]}\'\n"
+                    'Lazar Trsic',)
+
+CHANGES_PER_PAGE = 500
+# Query parameters shared by all requests for changes.
+CHANGES_OPTIONS = (
+    ('o', 'CURRENT_REVISION'),   # Required for DOWNLOAD_COMMANDS.
+    ('o', 'DOWNLOAD_COMMANDS'),  # Contains the git fetch command string.
+    ('n', str(CHANGES_PER_PAGE)),
+    ('pp', '0'),                 # Compact, not pretty-printed JSON.
+    )
+
+# Shared session, so that all Gerrit queries reuse the same HTTPS connection.
+# Throttled or failed queries are retried with exponential backoff.
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=urllib3.util.Retry(total=5, backoff_factor=0.5,
+                                   status_forcelist=(429, 500, 502, 503, 504),
+                                   respect_retry_after_header=True)))
+
+GERRIT_MAGIC_JSON_PREFIX = b")]}\'\n"
+GERRIT_MAGIC_PREFIX_LEN = len(GERRIT_MAGIC_JSON_PREFIX)
+
+# Decoded Gerrit responses, keyed by query and stored along with their ETag.
+CACHE_PATH = os.path.expanduser('~/.gerrit_author_merger_cache')
+
+FAIL_URL_FORMAT = (URL_HEADER + '/#/c/{}/').format
+PATCH_REF_RE = re.compile(r'refs/changes/\d+/\d+/\d+')
 
 PATH = '/home/paki/work/mipsia_master/art'
-GIT_CHECKOUT_AUTOMERGE_BRANCH = 'git checkout script_automerger'
-GIT_ABORT_CHERRY_PICK = 'git cherry-pick --abort'
-GIT_FULL_RESET_AOSP = 'git reset --hard aosp/master'
+WORKER_COUNT = 4
+GIT_FETCH = ['git', 'fetch']
+AOSP_MASTER = 'aosp/master'
+# Fetched patches are stored under refs/auto/<change number> while they are
+# checked, and deleted afterwards.
+LOCAL_PATCH_REF = 'refs/auto/{}'
 
 class CherryPickInfo(object):
     """ 
@@ -33,27 +74,33 @@ class CherryPickInfo(object):
     """
     def __init__(self, json_response):
         self.json_response  = json_response
-        self.created_time   = self.fetch_created_time()
-        self.updated_time   = self.fetch_updated_time()
-        self.number         = self.fetch_change_number()
-
-    def __fetch_field(self, field_name, nested_response = None):
-        """ Fetch a field with field_name from the JSON response. 
-        The nested_response argument is used to daisy-chain JSON array access.
 
-        returns:
-            Field contents as string.
-        raises:
-            KeyError if JSON does not contain said field.
-        """
-        if nested_response is None:
-            response = self.json_response
-        else:
-            response = nested_response
-        try:
-            return response[field_name]
-        except KeyError:
-            raise KeyError('no field ' + field_name + ' in JSON response')
+    @functools.cached_property
+    def created_time(self):
+        """ Time the patch-set was created, read from the response on first
+        use. """
+        return self.fetch_created_time()
+
+    @functools.cached_property
+    def updated_time(self):
+        """ Time the patch-set was last updated, read from the response on
+        first use. """
+        return self.fetch_updated_time()
+
+    @functools.cached_property
+    def number(self):
+        """ Gerrit patch number, read from the response on first use. """
+        return self.fetch_change_number()
+
+    @functools.cached_property
+    def cherry_pick_string(self):
+        """ Git cherry-pick commands, built from the response on first use. """
+        return self.fetch_cherry_pick_string()
+
+    @functools.cached_property
+    def fail_url(self):
+        """ URL to show when the cherry-pick fails, built on first use. """
+        return self.fetch_fail_url()
 
     def fetch_change_id(self):
         """ Return change_id from the response.
@@ -64,7 +111,7 @@ class CherryPickInfo(object):
             KeyError if response does not contain change_id.
 
         """
-        return self.__fetch_field('change_id')
+        return self.json_response['change_id']
     
     def fetch_change_number(self):
         """ Return the internal change number of the gerrit patch.
@@ -74,7 +121,7 @@ class CherryPickInfo(object):
         raises:
             KeyError if _number field is not present.
         """
-        return self.__fetch_field('_number')
+        return self.json_response['_number']
 
     def fetch_created_time(self):
         """ Return the time the patch-set was created, as string.
@@ -84,7 +131,7 @@ class CherryPickInfo(object):
         raises:
             KeyError if response does not contain created time.
         """
-        return self.__fetch_field('created')
+        return self.json_response['created']
 
     def fetch_updated_time(self):
         """ Return the last time the patch-set was updated, as string.
@@ -94,7 +141,7 @@ class CherryPickInfo(object):
         raises:
             KeyError if response does not contain updated time.
         """
-        return self.__fetch_field('updated')
+        return self.json_response['updated']
 
     def fetch_current_revision(self):
         """ Return the number of the current patch revision, as string.
@@ -104,25 +151,23 @@ class CherryPickInfo(object):
         raises:
             KeyError if response does not contain current_revision.
         """
-        return self.__fetch_field('current_revision')
+        return self.json_response['current_revision']
 
     def fetch_cherry_pick_string(self):
-        """ Build git cherry-pick string from the JSON response.
+        """ Build git cherry-pick commands from the JSON response. Gerrit
+        returns a single shell command of the form "git fetch ... && git
+        cherry-pick FETCH_HEAD", which is split into separate argument lists.
 
         returns: 
-            String command for git cherry-pick.
+            Tuple (git fetch argv, git cherry-pick argv).
         raises:
             KeyError if the JSON could not be parsed.
 
         """
-        cur_rev_id = self.fetch_current_revision()
-        all_revs = self.__fetch_field('revisions')
-        cur_rev = self.__fetch_field(cur_rev_id, all_revs)
-        fetch = self.__fetch_field('fetch', cur_rev)
-        http = self.__fetch_field('http', fetch)
-        commands = self.__fetch_field('commands', http)
-        cherry_pick = self.__fetch_field('Cherry Pick', commands)
-        return cherry_pick
+        data = self.json_response
+        cur_rev = data['revisions'][data['current_revision']]
+        cherry_pick = cur_rev['fetch']['http']['commands']['Cherry Pick']
+        return split_shell_command(cherry_pick)
 
     def fetch_fail_url(self):
         """ Return URL to pass to user when the cherry-pick is unsuccessful.
@@ -134,78 +179,127 @@ class CherryPickInfo(object):
         raises:
             KeyError if JSON could not be parsed.
         """
-        FAIL_URL_HEADER = "https://android-review.googlesource.com/#/c/"
-        return FAIL_URL_HEADER + str(self.number) + "/"
+        return FAIL_URL_FORMAT(self.number)
+
+def split_shell_command(command):
+    """ Split a shell command string of commands chained with && into
+    separate argument lists.
+
+    returns:
+        Tuple of argument lists, one for each chained command.
+    """
+    commands = [[]]
+    for token in shlex.split(command):
+        if token == '&&':
+            commands.append([])
+        else:
+            commands[-1].append(token)
+    return tuple(commands)
+
+def join_shell_command(commands):
+    """ Join argument lists into a single shell command string, with the
+    commands chained with &&.
 
-    created_time = ""
-    updated_time = ""
-    number = -1
+    returns:
+        Shell command string.
+    """
+    return ' && '.join(shlex.join(argv) for argv in commands)
 
-def call_bash_muted(command):
-    """Call an external bash command, with supressed output.
+def call_bash_muted(command, cwd=None):
+    """Call an external command given as argument list, with supressed output.
+    The command is run in the cwd directory, if given.
 
     returns:
         True if command succeds, False otherwise.
     """
-    bash_ret = subprocess.call(command, shell=True, stdout=subprocess.DEVNULL, 
-                               stderr=subprocess.STDOUT)
+    bash_ret = subprocess.call(command, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.STDOUT, cwd=cwd)
     if bash_ret == 0:
         return True
     else:
         return False
 
-def make_all_author_patches_query(project, owner, status='status:open'):
+def make_all_author_patches_query(project, owners, status='status:open'):
     """ Make a query string for fetching all patches on a project that belong
-    to author. The default status is open.
+    to any of the owners. The default status is open.
 
     returns:
-        Query string containing all 
+        Query string matching all patches of all owners.
     """
-    ret =   'project:' + project
-    ret +=  ' AND ' + status
-    ret +=  ' AND owner:\"' + owner + '\"' 
-    return ret
+    owner_query = ' OR '.join(f'owner:"{owner}"' for owner in owners)
+    return f'project:{project} AND {status} AND ({owner_query})'
 
 def decode_response(response):
     """ Strip off Gerrit's magic token and return the decoded JSON response.
+    The raw response bytes are decoded directly, without decoding them to a
+    string first. The token is always present, so it is only checked in
+    debug mode.
 
     returns:
-        Decoded JSON content as dict.
+        Decoded JSON content as list of dicts.
 
     raises:
         requests.HTTPError if the response contains a http error status code.
-        ValueError if the JSON could not be decoded.
+        orjson.JSONDecodeError (a ValueError) if the JSON could not be decoded.
 
     """
-    content = response.text
+    content = response.content
     try:
         response.raise_for_status()
     except Exception:
         print('ERROR on response to ' + response.url)
         print('server returns: ' + response.text)
 
-    if content.startswith(GERRIT_MAGIC_JSON_PREFIX):
-        content = content[len(GERRIT_MAGIC_JSON_PREFIX):]
+    # Gerrit always prefixes JSON responses with the magic token.
+    assert content[:GERRIT_MAGIC_PREFIX_LEN] == GERRIT_MAGIC_JSON_PREFIX
+    return orjson.loads(content[GERRIT_MAGIC_PREFIX_LEN:])
 
-    return json.loads(content)
+def get_changes(payload):
+    """ Query Gerrit for changes with the payload parameters. Decoded
+    responses are cached on disk along with their ETag, and a cached response
+    is reused when Gerrit reports it has not been modified.
 
-def get_author_cherry_picks(project, author):
-    """ For an author, fetch all git cherry-pick commands.
     returns:
-        List of tuples (git fetch command, fail display url)
+        Decoded JSON content as list of changes.
     """
-    query_string = make_all_author_patches_query(project, author)
-    payload = [('q', query_string),
-        ('o', 'CURRENT_REVISION'),   # Required for DOWNLOAD_COMMANDS.
-        ('o', 'DOWNLOAD_COMMANDS'),  # Contains the git fetch command string.
-        ]
+    key = urllib.parse.urlencode(payload)
+    headers = {}
+    with shelve.open(CACHE_PATH) as cache:
+        cached = cache.get(key)
+        if cached is not None:
+            headers['If-None-Match'] = cached[0]
+        response = SESSION.get(CHANGES_HEADER, params=payload, headers=headers)
+        if cached is not None and response.status_code == 304:
+            return cached[1]
+        changes = decode_response(response)
+        etag = response.headers.get('ETag')
+        if response.ok and etag:
+            cache[key] = (etag, changes)
+    return changes
+
+def get_cherry_picks(project, authors):
+    """ For all authors, fetch all git cherry-pick commands with a single
+    query. Gerrit limits the number of changes returned per request, so the
+    query is repeated with an offset while Gerrit reports more changes.
+
+    returns:
+        List of tuples (git fetch command, fail display url, change number)
+    """
+    query_string = make_all_author_patches_query(project, authors)
     return_list = []
-    response = requests.get(CHANGES_HEADER, params=payload)
-    for data in decode_response(response):
-        info = CherryPickInfo(data)
-        cp_string = info.fetch_cherry_pick_string()
-        fail_url = info.fetch_fail_url()
-        return_list.append((cp_string, fail_url))
+    offset = 0
+    while True:
+        payload = ((('q', query_string),) + CHANGES_OPTIONS +
+                   (('S', str(offset)),))
+        data = None
+        for data in get_changes(payload):
+            info = CherryPickInfo(data)
+            return_list.append((info.cherry_pick_string, info.fail_url,
+                                info.number))
+            offset += 1
+        # Gerrit marks the last change of a truncated page with _more_changes.
+        if data is None or not data.get('_more_changes', False):
+            break
 
     return return_list
 
@@ -219,69 +313,128 @@ def test_print(in_list):
     -------------------------------------------------
     """
     for elem in in_list:
-        print(elem[0])
+        print(join_shell_command(elem[0]))
 
     print('')
 
     for elem in in_list:
         print(elem[1])
 
-def try_cherry_pick(command):
-    """ Try a cherry-pick for a commit. Use the specified command passed from
-    the fetcher. If the cherry-pick fails, abort it.
+def fetch_patches(patch_list):
+    """ Fetch all patches from patch_list with a single git fetch per remote.
+    Every patch is stored to a local ref, so it can be cherry-picked without
+    further network access. The local refs should be removed with
+    delete_patch_refs when they are no longer needed.
+
+    returns:
+        List of local refs, in the same order as patch_list.
+    raises:
+        RuntimeError if the patches could not be fetched from a remote. Any
+        refs fetched up to that point are deleted.
+    """
+    refspecs = {}
+    local_refs = []
+    for patch in patch_list:
+        fetch_command = patch[0][0]
+        url = fetch_command[len(GIT_FETCH)]
+        remote_ref = PATCH_REF_RE.search(' '.join(fetch_command)).group(0)
+        local_ref = LOCAL_PATCH_REF.format(patch[2])
+        refspecs.setdefault(url, []).append('+' + remote_ref + ':' +
+                                            local_ref)
+        local_refs.append(local_ref)
+
+    for url, url_refspecs in refspecs.items():
+        if not call_bash_muted(GIT_FETCH + [url] + url_refspecs, cwd=PATH):
+            delete_patch_refs(local_refs)
+            raise RuntimeError('failed to fetch patches from ' + url)
+    return local_refs
+
+def delete_patch_refs(local_refs):
+    """ Delete the local refs created by fetch_patches from the repository
+    at PATH. Refs that do not exist are skipped.
+    """
+    repo = pygit2.Repository(PATH)
+    for ref in local_refs:
+        if ref in repo.references:
+            repo.references.delete(ref)
+
+def try_cherry_pick(repo, base, ref):
+    """ Check if a commit from a local ref can be cherry-picked on top of the
+    base commit, without touching the index or the working tree. This is done
+    with an in-memory three-way merge of the trees, using the parent of the
+    commit as the merge base, just as git cherry-pick does. This replaces
+    Repository.cherrypick, which would have to write a working tree.
 
     returns:
-        True if cherry-pick was successfull, False otherwise.
+        True if cherry-pick would be successfull, False otherwise.
     """
-    res = call_bash_muted(command)
-    if not res:
-        call_bash_muted(GIT_ABORT_CHERRY_PICK)
-    return res
+    commit = repo.revparse_single(ref)
+    if len(commit.parents) != 1:
+        return False
+    index = repo.merge_trees(commit.parents[0].tree, base.tree, commit.tree)
+    return index.conflicts is None
+
+def try_isolated_cherry_pick(ref, repos):
+    """ Check if a commit can be cherry-picked on top of master, using the
+    first free repository from the repos queue. pygit2 repositories must not
+    be shared between threads, so the repository is returned to the queue
+    afterwards.
+
+    returns:
+        True if cherry-pick would be successfull, False otherwise.
+    """
+    repo = repos.get()
+    try:
+        return try_cherry_pick(repo, repo.revparse_single(AOSP_MASTER), ref)
+    finally:
+        repos.put(repo)
 
 def form_patch_list(sort=True):
     """ Form a list of patches belonging to all authors. The will optionally
-    be sorted.
+    be sorted. All authors are fetched with a single Gerrit query.
 
     returns:
         A list of patches belonging to all authors
     """
-    patch_list = []
-    for author in AUTHORS:
-        author_result = get_author_cherry_picks(PROJECT, author)
-        if author_result:
-            patch_list += author_result
+    patch_list = get_cherry_picks(PROJECT, AUTHORS)
 
     # Sort the list by commit number:
-    patch_list.sort(key=lambda number:number[1])
+    if sort:
+        patch_list.sort(key=operator.itemgetter(2))
     return patch_list
 
 def try_regular_list(patch_list):
     """ Try and cherry-pick every patch on top of current master, then build
-    a list of all patches that can be cherry-picked like this. The patches
-    that cannot be cherry-picked in regular order are set aside for manual
-    inspection. 
+    a list of all patches that can be cherry-picked like this. All patches are
+    fetched up front, then each patch is checked on its own on top of master,
+    and the patches are checked concurrently. Patches that apply cleanly on
+    their own may still conflict with each other. The patches that cannot be
+    cherry-picked are set aside for manual inspection.
 
     returns:
         Tuple (A, B):
-            A: list of patches merged in regular order
-            B: sorted list of patches that cannot be merged in regular order
+            A: list of patches that apply cleanly to master on their own
+            B: sorted list of patches that cannot be applied to master
     """
-    # TODO: do this through decorator/contextmanager.
     regular_list = []
     unmerged_list = []
-    old_path = os.getcwd()  
+    local_refs = fetch_patches(patch_list)
     try:
-        os.chdir(PATH)
-        call_bash_muted(GIT_CHECKOUT_AUTOMERGE_BRANCH)
-        # Reset the branch to master before applyting any changes.
-        call_bash_muted(GIT_FULL_RESET_AOSP)
-        for patch in patch_list:
-            if try_cherry_pick(patch[0]):
-                regular_list.append(patch)
-            else:
-                unmerged_list.append(patch)
+        repos = queue.Queue()
+        for _ in range(WORKER_COUNT):
+            repos.put(pygit2.Repository(PATH))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=WORKER_COUNT) as executor:
+            results = list(executor.map(
+                lambda ref: try_isolated_cherry_pick(ref, repos), local_refs))
     finally:
-        os.chdir(old_path)
+        delete_patch_refs(local_refs)
+
+    for patch, merged in zip(patch_list, results):
+        if merged:
+            regular_list.append(patch)
+        else:
+            unmerged_list.append(patch)
     return (regular_list, unmerged_list)
 
 def print_report(start_list, regular_list, unmerged_list,
@@ -298,7 +451,7 @@ def print_report(start_list, regular_list, unmerged_list,
     https://android-review.googlesource.com/#/c/<num>/
     ...
 
-    The following commands will merge the patches in regular order:
+    Each of the following patches applies cleanly to aosp/master on its own:
     git fetch https://android.googlesource.com/platform/art
         refs/changes/65/<patch_no>/<ps_no> && git cherry-pick FETCH_HEAD
     ...
@@ -313,29 +466,29 @@ def print_report(start_list, regular_list, unmerged_list,
     ...
 
     """
-    # TODO: figure out a nicer way to print tuples other than for...
-    print('Patch list report:')
-    print('Project:', PROJECT)
-    print('Branch:', BRANCH)
-    print('Authors:', *AUTHORS, sep=' ')
-    print()
-    print('Open patches:')
-    for patch_tuple in start_list:
-        print(patch_tuple[1])
-    print()
-    print('The following commands will merge the patches in regular order:')
-    for patch_tuple in regular_list:
-            print(patch_tuple[0])
-    print()
-    print('Unable to merge patches:')
-    for patch_tuple in unmerged_list:
-        print(patch_tuple[1])
-    print()
-    print('You may try to merge conflicting patches with the following',
-          'commands:')
-    for patch_tuple in unmerged_list:
-        print(patch_tuple[0])
-    print()
+    lines = ['Patch list report:',
+             f'Project: {PROJECT}',
+             f'Branch: {BRANCH}',
+             f'Authors: {" ".join(AUTHORS)}',
+             '',
+             'Open patches:']
+    lines.extend(patch_tuple[1] for patch_tuple in start_list)
+    lines.append('')
+    lines.append('Each of the following patches applies cleanly to ' +
+                 AOSP_MASTER + ' on its own:')
+    lines.extend(join_shell_command(patch_tuple[0])
+                 for patch_tuple in regular_list)
+    lines.append('')
+    lines.append('Unable to merge patches:')
+    lines.extend(patch_tuple[1] for patch_tuple in unmerged_list)
+    lines.append('')
+    lines.append('You may try to merge conflicting patches with the following '
+                 'commands:')
+    lines.extend(join_shell_command(patch_tuple[0])
+                 for patch_tuple in unmerged_list)
+    lines.append('')
+    # Write the whole report at once, instead of a write per line.
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def main():